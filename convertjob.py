@@ -0,0 +1,177 @@
+'''
+Created on 19.10.2026
+
+Background osmconvert jobs for guiconvert.
+Nothing here depends on wx: progress is reported through callbacks
+called from the worker thread, GUI should pass them via wx.CallAfter.
+'''
+import logging
+import Queue
+import subprocess
+import tempfile
+import threading
+import time
+from osmupdate import osmconvert, outputfile, out_format_arg
+
+
+def convert_cmd(sources, filename, merge_versions=False, crop_args=[]):
+    '''osmconvert command converting 'sources' into 'filename'
+    Output format is taken from filename extension.
+    '''
+    cmd = [osmconvert]
+    if merge_versions:
+        cmd.append("--merge-versions")
+    cmd.extend(sources)
+    cmd.extend(crop_args)
+    cmd.append(out_format_arg(filename))
+    return cmd
+
+
+class ConvertJob(object):
+    '''osmconvert run streaming its output to file in a worker thread
+    on_progress(job) is called not more often than 'interval' seconds,
+    on_done(job) is called once when job finished, failed or cancelled.
+    Both are called from the worker thread.
+    '''
+    def __init__(self, cmd, filename, on_progress=None, on_done=None,
+                 interval=0.5):
+        self.cmd = cmd
+        self.filename = filename
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.interval = interval
+        self.written = 0
+        self.rate = 0.0
+        self.error = None
+        self.started = False
+        self.finished = False
+        self._cancel = threading.Event()
+        self._proc = None
+        self._thread = None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def running(self):
+        return self.started and not self.finished
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+        proc = self._proc
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+
+    def run(self):
+        '''Do the job in current thread'''
+        if self.cancelled:
+            #cancelled while waiting in queue
+            self.finished = True
+            if self.on_done:
+                self.on_done(self)
+            return
+        self.started = True
+        started = time.time()
+        reported = started
+        res_file = None
+        try:
+            res_file = outputfile(self.filename)
+            errors = tempfile.TemporaryFile()
+            self._proc = subprocess.Popen(self.cmd, shell=False,
+                                          bufsize=1 << 16,
+                                          stdout=subprocess.PIPE,
+                                          stderr=errors)
+            if self.cancelled:
+                self._proc.terminate()
+            #large chunks: per chunk work in outputfile is done in C
+            #and releases GIL, so parallel jobs do not block each other
+            for chunk in iter(lambda: self._proc.stdout.read(1 << 16), ""):
+                if self.cancelled:
+                    break
+                res_file.write(chunk)
+                self.written += len(chunk)
+                now = time.time()
+                if now - reported >= self.interval:
+                    reported = now
+                    self.rate = self.written / (now - started)
+                    if self.on_progress:
+                        self.on_progress(self)
+            self._proc.stdout.close()
+            result = self._proc.wait()
+            if self.cancelled:
+                res_file.abort()
+            elif result != 0:
+                res_file.abort()
+                errors.seek(0)
+                self.error = errors.read().strip() or \
+                    "osmconvert exited with code %i" % result
+            else:
+                res_file.close()
+            errors.close()
+        except Exception as e:
+            logging.exception("Conversion failed: " + " ".join(self.cmd))
+            if res_file is not None:
+                res_file.abort()
+            self.error = str(e)
+        finally:
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.kill()
+            elapsed = time.time() - started
+            if elapsed > 0:
+                self.rate = self.written / elapsed
+            self.finished = True
+            if self.on_done:
+                self.on_done(self)
+
+
+class JobQueue(object):
+    '''Run ConvertJobs with not more than 'workers' of them at once
+    on_done(queue) is called from a worker thread after the last job.
+    Jobs are taken in list order, so put the largest ones first.
+    '''
+    def __init__(self, jobs, workers=1, on_done=None):
+        self.jobs = list(jobs)
+        self.workers = max(1, min(workers, len(self.jobs)))
+        self.on_done = on_done
+        self._queue = Queue.Queue()
+        self._left = len(self.jobs)
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self._left == 0
+
+    def start(self):
+        if not self.jobs:
+            if self.on_done:
+                self.on_done(self)
+            return
+        for job in self.jobs:
+            self._queue.put(job)
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+
+    def cancel(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            job.run()
+            with self._lock:
+                self._left -= 1
+                last = self._left == 0
+            if last and self.on_done:
+                self.on_done(self)
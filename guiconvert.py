@@ -2,21 +2,51 @@
 Created on 31.08.2013
 
 @author: scond_000
+
+No wx objects are created at import and conversion engine is imported
+on first conversion. Check with --startup-benchmark
 '''
+import time
+_started = time.time()
 import wx
 import wx.combo as combo
 import wx.gizmos as gizmos
-import subprocess
 import logging
-import gzip
 import os.path
-
-app = wx.App()
+import sys
 
 
 class CropCfg(wx.Panel):
     def __init__(self, *args, **kwargs):
         wx.Panel.__init__(self, *args, **kwargs)
+        self.sizer = wx.BoxSizer(wx.VERTICAL)
+        self.blbl = wx.StaticText(self, label="Bounding box "
+                                  "(west,south,east,north)")
+        self.bbox = wx.TextCtrl(self)
+        self.plbl = wx.StaticText(self, label="Border polygon")
+        self.poly = wx.FilePickerCtrl(self, message="Choose border polygon",
+                                      wildcard="Polygon files (*.poly)|*.poly"
+                                      "|All files (*.*)|*.*")
+        self.cwcb = wx.CheckBox(self, label="Complete ways and relations")
+        self.sizer.Add(self.blbl, flag=wx.ALL, border=3)
+        self.sizer.Add(self.bbox, 0, flag=wx.EXPAND)
+        self.sizer.AddSpacer(5)
+        self.sizer.Add(self.plbl, flag=wx.ALL, border=3)
+        self.sizer.Add(self.poly, 0, flag=wx.EXPAND)
+        self.sizer.AddSpacer(5)
+        self.sizer.Add(self.cwcb)
+        self.SetSizer(self.sizer)
+
+    @property
+    def osmconvert_args(self):
+        args = []
+        if self.poly.GetPath():
+            args.append("-B=" + self.poly.GetPath())
+        elif self.bbox.GetValue().strip():
+            args.append("-b=" + self.bbox.GetValue().strip())
+        if args and self.cwcb.IsChecked():
+            args.extend(["--complete-ways", "--complex-ways"])
+        return args
 
 
 class FileSelectorCombo(combo.ComboCtrl):
@@ -101,12 +131,27 @@ class ResultCfg(wx.Panel):
             ext = ext + ".gz"
         return ext
 
-    def UpdateExt(self):
-        filename = self.filsel.GetValue()
+    def name4ext(self, filename):
         if filename.endswith('.gz'):
             filename = filename[:-3]
         filename = os.path.splitext(filename)[0]
-        self.filsel.SetValue('.'.join((filename, self.ext4cfg)))
+        return '.'.join((filename, self.ext4cfg))
+
+    def UpdateExt(self):
+        self.filsel.SetValue(self.name4ext(self.filsel.GetValue()))
+
+    def names4sources(self, sources):
+        '''Output file for each source converted separately
+        Files are put in folder of selected output file if any,
+        otherwise beside the source.
+        '''
+        folder = os.path.dirname(self.filsel.GetValue())
+        names = []
+        for source in sources:
+            name = os.path.join(folder or os.path.dirname(source),
+                                os.path.basename(source))
+            names.append(self.name4ext(name))
+        return names
 
     @property
     def changefile(self):
@@ -142,7 +187,12 @@ class SourceCfg(wx.Panel):
     def evt_test(self, event):
         logging.warn(event)
 
+    @property
+    def sources(self):
+        return [it for it in self.inlist.GetStrings() if it]
+
     def __init__(self, *args, **kwargs):
+        import multiprocessing
         wx.Panel.__init__(self, *args, **kwargs)
         self.inlist = gizmos.EditableListBox(self, -1, "Source files", (0, 0),
                                              (200, 150),
@@ -157,6 +207,17 @@ class SourceCfg(wx.Panel):
         self.mrg = wx.CheckBox(self, label="Merge revisions")
         self.sizer.AddSpacer(5)
         self.sizer.Add(self.mrg)
+        self.sep = wx.CheckBox(self, label="Convert each source separately")
+        self.sizer.AddSpacer(5)
+        self.sizer.Add(self.sep)
+        self.wrk = wx.BoxSizer(wx.HORIZONTAL)
+        self.wlbl = wx.StaticText(self, label="Parallel jobs")
+        self.workers = wx.SpinCtrl(self, min=1, max=64,
+                                   initial=min(64, multiprocessing.cpu_count()))
+        self.wrk.Add(self.wlbl, flag=wx.ALL, border=3)
+        self.wrk.Add(self.workers)
+        self.sizer.AddSpacer(5)
+        self.sizer.Add(self.wrk)
         self.SetSizer(self.sizer)
 
 
@@ -173,15 +234,169 @@ class Window(wx.Frame):
         self.crop = CropCfg(self.config)
         self.config.AddPage(self.crop, "Crop")
         self.gopanel = wx.Panel(self)
+        self.joblist = wx.ListCtrl(self, size=(-1, 100), style=wx.LC_REPORT)
+        self.joblist.InsertColumn(0, "Source")
+        self.joblist.InsertColumn(1, "Output")
+        self.joblist.InsertColumn(2, "Status", width=200)
         self.sizer.Add(self.config, 1, flag=wx.EXPAND)
+        self.sizer.Add(self.joblist, flag=wx.ALL + wx.EXPAND)
         self.sizer.Add(self.gopanel, flag=wx.ALL + wx.EXPAND)
+        self.gosizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.gauge = wx.Gauge(self.gopanel)
+        self.status = wx.StaticText(self.gopanel)
         self.gobtn = wx.Button(self.gopanel, label="Convert")
+        self.gosizer.Add(self.gauge, 1, flag=wx.ALL + wx.EXPAND, border=3)
+        self.gosizer.Add(self.status, 1, flag=wx.ALL + wx.EXPAND, border=3)
+        self.gosizer.Add(self.gobtn, flag=wx.ALL, border=3)
+        self.gopanel.SetSizer(self.gosizer)
+        self.Bind(wx.EVT_BUTTON, self.OnConvert, self.gobtn)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
+        self.queue = None
+        self.closing = False
         self.SetSizer(self.sizer)
         #self.SetAutoLayout(1)
         self.sizer.Fit(self)
 
+    def tasks(self, sources):
+        '''List of (sources, output file) to convert
+        None if configuration is not complete
+        '''
+        if not self.source.sep.IsChecked():
+            if not self.result.filsel.GetValue():
+                wx.MessageBox("Select output file first", "OsmConvert",
+                              wx.OK | wx.ICON_ERROR, self)
+                return None
+            self.result.UpdateExt()
+            return [(sources, self.result.filsel.GetValue())]
+        #largest first, so batch takes about the time of the largest
+        sources = sorted(sources, reverse=True,
+                         key=lambda s: os.path.getsize(s)
+                         if os.path.exists(s) else 0)
+        outputs = self.result.names4sources(sources)
+        clash = [o for s, o in zip(sources, outputs)
+                 if os.path.abspath(s) == os.path.abspath(o)]
+        if clash or len(set(outputs)) < len(outputs):
+            wx.MessageBox("Output files clash with sources or each other.\n"
+                          "Select another format or output folder.",
+                          "OsmConvert", wx.OK | wx.ICON_ERROR, self)
+            return None
+        return [([s], o) for s, o in zip(sources, outputs)]
+
+    def OnConvert(self, event):
+        if self.queue is not None and not self.queue.finished:
+            self.queue.cancel()
+            self.gobtn.Disable()
+            return
+        sources = self.source.sources
+        if not sources:
+            wx.MessageBox("Add source files first", "OsmConvert",
+                          wx.OK | wx.ICON_ERROR, self)
+            return
+        tasks = self.tasks(sources)
+        if not tasks:
+            return
+        from convertjob import ConvertJob, JobQueue, convert_cmd
+        merge = self.source.mrg.IsChecked()
+        crop = self.crop.osmconvert_args
+        self.joblist.DeleteAllItems()
+        jobs = []
+        for row, (task_sources, filename) in enumerate(tasks):
+            cmd = convert_cmd(task_sources, filename, merge, crop)
+            logging.info(" ".join(cmd))
+            jobs.append(ConvertJob(cmd, filename,
+                            lambda job: wx.CallAfter(self.OnProgress, job),
+                            lambda job: wx.CallAfter(self.OnJobDone, job)))
+            self.joblist.InsertStringItem(row, ", ".join(task_sources))
+            self.joblist.SetStringItem(row, 1, filename)
+            self.joblist.SetStringItem(row, 2, "Waiting")
+        workers = self.source.workers.GetValue() \
+                    if self.source.sep.IsChecked() else 1
+        self.queue = JobQueue(jobs, workers,
+                              lambda queue: wx.CallAfter(self.OnDone, queue))
+        self.config.Disable()
+        self.gobtn.SetLabel("Cancel")
+        self.gauge.SetRange(len(jobs))
+        self.gauge.SetValue(0)
+        self.status.SetLabel("Starting")
+        self.queue.start()
+
+    def OnProgress(self, job):
+        if self.queue is None or job not in self.queue.jobs or job.finished:
+            return
+        self.joblist.SetStringItem(self.queue.jobs.index(job), 2,
+                                   "%.1f MB, %.1f MB/s" %
+                                   (job.written / 1048576.0,
+                                    job.rate / 1048576.0))
+        if len(self.queue.jobs) == 1:
+            self.gauge.Pulse()
+        rate = sum(j.rate for j in self.queue.jobs if j.running)
+        self.status.SetLabel("%.1f MB written, %.1f MB/s" %
+                             (sum(j.written for j in self.queue.jobs)
+                              / 1048576.0, rate / 1048576.0))
+
+    def OnJobDone(self, job):
+        if self.queue is None or job not in self.queue.jobs:
+            return
+        if job.cancelled:
+            state = "Cancelled"
+        elif job.error:
+            state = "Failed"
+        else:
+            state = "Done: %.1f MB, %.1f MB/s" % (job.written / 1048576.0,
+                                                 job.rate / 1048576.0)
+        self.joblist.SetStringItem(self.queue.jobs.index(job), 2, state)
+        self.gauge.SetValue(len([j for j in self.queue.jobs if j.finished]))
+
+    def OnDone(self, queue):
+        if queue is not self.queue:
+            return
+        if self.closing:
+            #jobs have cleaned up their tempfiles, close now
+            self.Close()
+            return
+        self.config.Enable()
+        self.gobtn.Enable()
+        self.gobtn.SetLabel("Convert")
+        self.gauge.SetValue(self.gauge.GetRange())
+        failed = [job for job in queue.jobs if job.error]
+        if [job for job in queue.jobs if job.cancelled]:
+            self.status.SetLabel("Cancelled")
+        elif failed:
+            self.status.SetLabel("%i of %i failed" % (len(failed),
+                                                      len(queue.jobs)))
+            wx.MessageBox("\n".join("%s: %s" % (job.filename, job.error)
+                                    for job in failed),
+                          "OsmConvert", wx.OK | wx.ICON_ERROR, self)
+        else:
+            self.status.SetLabel("Done: %.1f MB" %
+                                 (sum(job.written for job in queue.jobs)
+                                  / 1048576.0))
+
+    def OnClose(self, event):
+        if self.queue is not None and not self.queue.finished:
+            self.queue.cancel()
+            if event.CanVeto():
+                #worker threads are daemons: wait for them to drop
+                #partial output, OnDone closes the window
+                self.closing = True
+                self.gobtn.Disable()
+                self.status.SetLabel("Cancelling")
+                event.Veto()
+                return
+        event.Skip()
+
 
 if __name__ == "__main__":
+    if "--startup-benchmark" in sys.argv[1:]:
+        elapsed = time.time() - _started
+        from osmupdate import startup_report
+        ok = startup_report(elapsed, ["convertjob", "subprocess",
+                                      "multiprocessing"])
+        if wx.GetApp() is not None:
+            print("wx.App created at import")
+            ok = False
+        sys.exit(0 if ok else 1)
+    app = wx.App()
     wnd = Window(None, "OsmConvert")
     wnd.Show(True)
     app.MainLoop()
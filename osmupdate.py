@@ -14,6 +14,9 @@ console help. Now supports: '-b'; '-B'
 
 * tempfiles saved in standard tempdir by default
 
+* networking, subprocess and argparse are imported only when needed,
+so module is cheap to import. Check with --startup-benchmark
+
 // This program is free software; you can redistribute it and/or
 // modify it under the terms of the GNU Affero General Public License
 // version 3 as published by the Free Software Foundation.
@@ -24,20 +27,22 @@ console help. Now supports: '-b'; '-B'
 // You should have received a copy of this license along
 // with this program; if not, see http://www.gnu.org/licenses/.
 '''
-import argparse
+import time
+_started = time.time()
 import logging
-import tempfile
 from datetime import datetime, timedelta
-import subprocess
 import os
-import shutil
+import sys
 from os.path import getsize
-import urllib
 version = "0.3P"
 osmconvert = "osmconvert"
 global_base_url = "http://planet.openstreetmap.org/replication"
 global_base_url_suffix = ""
 global_osmconvert_arguments = []
+#umask can be read only by setting it, and it is process-wide:
+#read it once here, not from output writing threads
+_umask = os.umask(0)
+os.umask(_umask)
 
 
 def remove(path):
@@ -45,6 +50,23 @@ def remove(path):
         os.remove(path)
 
 
+#Modules below are not needed to import this one,
+#they are imported on first use to keep startup cheap
+def _subprocess():
+    import subprocess
+    return subprocess
+
+
+def _tempfile():
+    import tempfile
+    return tempfile
+
+
+def _urllib():
+    import urllib
+    return urllib
+
+
 def strtodatetime(s):
     """
     Read a timestamp in OSM format, e.g.: "2010-09-30T19:23:30Z", and
@@ -85,14 +107,14 @@ def get_file_timestamp(file_name):
     If the file timestamp is not available, this procedure tries
     to retrieve the timestamp from the file's statistics
     """
-    result = subprocess.check_output([osmconvert,
+    result = _subprocess().check_output([osmconvert,
                                       "--out-timestamp", file_name])
     file_timestamp = strtodatetime(result)
     if not file_timestamp:
         # try to get the timestamp from the file's statistics
         logging.info("file %s has no file timestamp." % file_name)
         logging.info("Running statistics to get the timestamp.")
-        result = subprocess.check_output([osmconvert,
+        result = _subprocess().check_output([osmconvert,
                                           "--out-statistics", file_name])
         p = result.find("timestamp max: ")
         if p:
@@ -123,7 +145,7 @@ class changefiles(object):
 
         changefile_timestamp = None
         file_sequence_number = 0
-        for result in urllib.urlopen(self.url + "/state.txt"):
+        for result in _urllib().urlopen(self.url + "/state.txt"):
             # get sequence number
             sequence_number_p = result.find("sequenceNumber=")
             if sequence_number_p != -1:
@@ -151,18 +173,17 @@ class changefiles(object):
         num = self.lastnum(nocache)
         return self.cache_seq.get(num)
 
-    @property
-    def nowtime(self):
+    def timeof(self, num):
         """Date/time of a specific changefile
         which is available in the Internet
         """
-        if self.nownum not in self.cache_seq:
+        if num not in self.cache_seq:
             url = self.url + ("/%03i/%03i/%03i" % \
-                              (self.nownum / 1000000,
-                               self.nownum / 1000 % 1000,
-                               self.nownum % 1000)) + ".state.txt"
+                              (num / 1000000,
+                               num / 1000 % 1000,
+                               num % 1000)) + ".state.txt"
             changefile_timestamp = None
-            for result in urllib.urlopen(url):
+            for result in _urllib().urlopen(url):
                 # get timestamp
                 timestamp_p = result.find("timestamp=")
                 if timestamp_p != -1:
@@ -172,15 +193,49 @@ class changefiles(object):
                     changefile_timestamp = strtodatetime(result)
 
             if not changefile_timestamp:
-                AssertionError("no timestamp for %s changefile %i." %
-                           (self.changefile_type, self.nownum))
+                raise AssertionError("no timestamp for %s changefile %i." %
+                           (self.changefile_type, num))
             else:
                 logging.info("%s, id: %i, timestamp: %s" %
-                                (self.changefile_type, self.nownum,
+                                (self.changefile_type, num,
                                 changefile_timestamp.isoformat()))
-                self.cache_seq[self.nownum] = changefile_timestamp
+                self.cache_seq[num] = changefile_timestamp
 
-        return self.cache_seq[self.nownum]
+        return self.cache_seq[num]
+
+    @property
+    def nowtime(self):
+        """Date/time of current changefile"""
+        return self.timeof(self.nownum)
+
+    def seek(self, timestamp):
+        '''Set current changefile to the newest one
+        not newer than timestamp.
+        Steps back with doubling stride and then bisects,
+        so only a few state files are downloaded.
+        '''
+        newer = self.lastnum()
+        if self.timeof(newer) <= timestamp:
+            self.nownum = newer
+            return self.nownum
+        older = newer
+        stride = 1
+        while self.timeof(older) > timestamp:
+            if older == 0:
+                raise AssertionError("No %s changefile before %s." %
+                                     (self.changefile_type,
+                                      timestamp.isoformat()))
+            newer = older
+            older = max(0, older - stride)
+            stride *= 2
+        while newer - older > 1:
+            middle = (newer + older) / 2
+            if self.timeof(middle) > timestamp:
+                newer = middle
+            else:
+                older = middle
+        self.nownum = older
+        return self.nownum
 
 
 class filecache(object):
@@ -206,7 +261,7 @@ class filecache(object):
             url = url + ("%03i/%03i/%03i.osc.gz" % (file_sequence_number / 1000000,
                                             file_sequence_number / 1000 % 1000,
                                                 file_sequence_number % 1000))
-            urllib.urlretrieve(url, this_cachefile_name)
+            _urllib().urlretrieve(url, this_cachefile_name)
         logging.info("%s changefile %i: downloaded" %
                      (changefile_type, file_sequence_number))
         self.cachedfiles.append(this_cachefile_name)
@@ -214,13 +269,16 @@ class filecache(object):
         if new_timestamp > self.newest_time:
             self.newest_time = new_timestamp
 
-    def mergefiles(self, files=[], osmconvert_args=[]):
+    def mergefiles(self, files=[], osmconvert_args=[], result_file=None,
+                   compression_level=9):
         '''Merging list of changefiles into one o5c file
+        If 'result_file' is given, merged file is written there
+        with write_output
         return filename of merged file
         '''
         if files == []:
             return ""
-        if len(files) == 1 and osmconvert_args == []:
+        if len(files) == 1 and osmconvert_args == [] and result_file is None:
             return files[0]
         logging.info("Merging changefiles.")
         cmd = [osmconvert]
@@ -230,8 +288,12 @@ class filecache(object):
         cmd.extend(files)
         cmd.extend(osmconvert_args)
         cmd.append("--out-o5c")
-        (sum_cache, filename) = tempfile.mkstemp(".tmp.o5c", "", self.folder)
-        result = subprocess.call(cmd, stdout=sum_cache, shell=False)
+        if result_file is not None:
+            write_output(cmd, result_file, compression_level)
+            return result_file
+        (sum_cache, filename) = _tempfile().mkstemp(".tmp.o5c", "",
+                                                    self.folder)
+        result = _subprocess().call(cmd, stdout=sum_cache, shell=False)
         os.close(sum_cache)
         if not os.path.exists(filename) or getsize(filename) < 10 or \
             result != 0:
@@ -255,19 +317,384 @@ class filecache(object):
                     remove(filename)
             self.cachedfiles = newlist
 
-    def resultfile(self, maxfiles):
+    def resultfile(self, maxfiles, result_file=None, compression_level=9):
         '''Return filename of file with all files merged
         and latest timestamp applied
+        If 'result_file' is given, the last merge writes it directly
         '''
         self.densefiles(maxfiles)
         conv_args = global_osmconvert_arguments
         if self.newest_time > datetime(1990, 1, 1):
             conv_args.append("--timestamp=" +\
                        self.newest_time.strftime("%Y-%m-%dT%H:%M:%SZ"))
-        return self.mergefiles(self.cachedfiles, conv_args)
+        return self.mergefiles(self.cachedfiles, conv_args, result_file,
+                               compression_level)
+
+
+class _digestfile(object):
+    '''File wrapper hashing bytes on their way to disk'''
+    def __init__(self, fileobj):
+        import hashlib
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class outputfile(object):
+    '''Output file written atomically with inline verification
+    Data is written to a tempfile beside 'filename', hashed and counted
+    while written. close() renames it to 'filename' and writes sidecar
+    manifest 'filename.manifest', so file is never read twice.
+    '''
+    def __init__(self, filename, compression_level=9):
+        self.filename = filename
+        (fd, self.tempname) = self._mkstemp(filename)
+        self.raw = _digestfile(os.fdopen(fd, 'wb'))
+        if filename.endswith(".gz"):
+            import gzip
+            self.fileobj = gzip.GzipFile(os.path.basename(filename)[:-3],
+                                         'wb', compression_level, self.raw)
+            filename = filename[:-3]
+        else:
+            self.fileobj = self.raw
+        #Element counters are cheap only for XML formats,
+        #"<node " etc. can not appear inside escaped attribute values
+        if os.path.splitext(filename)[1] in (".osm", ".osc", ".osh"):
+            self.counters = {"node": 0, "way": 0, "relation": 0}
+        else:
+            self.counters = {}
+        #unfinished last line of previous chunk, to count tags
+        #split between chunks
+        self._tail = ""
+
+    def write(self, data):
+        '''Write chunk of data
+        Work per chunk is done in C, so large chunks (64k and more)
+        keep Python overhead low and let hashlib and zlib release GIL
+        '''
+        if self.counters:
+            end = data.rfind("\n") + 1
+            if end:
+                text = self._tail + data[:end]
+                self._tail = data[end:]
+                for tag in self.counters:
+                    self.counters[tag] += text.count("<%s " % tag)
+            else:
+                self._tail += data
+        self.fileobj.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _count_tail(self):
+        for tag in self.counters:
+            self.counters[tag] += self._tail.count("<%s " % tag)
+        self._tail = ""
+
+    def _mkstemp(self, filename):
+        #beside 'filename' to be renamed over it atomically
+        return _tempfile().mkstemp(".tmp", os.path.basename(filename) + ".",
+                                   os.path.dirname(filename) or ".")
+
+    def _replace(self, tempname, filename):
+        #mkstemp creates private files, use usual permissions instead
+        os.chmod(tempname, 0o666 & ~_umask)
+        if os.name == "nt":
+            #rename does not overwrite on Windows
+            remove(filename)
+        os.rename(tempname, filename)
+
+    def close(self):
+        '''Publish file and its manifest'''
+        self._count_tail()
+        if self.fileobj is not self.raw:
+            self.fileobj.close()
+        self.raw.close()
+        self._replace(self.tempname, self.filename)
+        manifest = self.filename + ".manifest"
+        (fd, tempname) = self._mkstemp(manifest)
+        try:
+            f = os.fdopen(fd, 'w')
+            f.write("sha256=%s\n" % self.raw.sha256.hexdigest())
+            f.write("size=%i\n" % self.raw.size)
+            for tag in sorted(self.counters):
+                f.write("%ss=%i\n" % (tag, self.counters[tag]))
+            f.close()
+            self._replace(tempname, manifest)
+        except:
+            remove(tempname)
+            raise
+        logging.info("%s: %i bytes, sha256 %s" % (self.filename,
+                                                 self.raw.size,
+                                                 self.raw.sha256.hexdigest()))
+
+    def abort(self):
+        '''Drop written data, leave existing file untouched'''
+        if self.fileobj is not self.raw:
+            self.fileobj.close()
+        self.raw.close()
+        remove(self.tempname)
+
+
+def read_manifest(filename):
+    '''Read sidecar manifest of output file
+    return dict like {"sha256": "...", "size": 123, "nodes": 45}
+    '''
+    manifest = {}
+    for line in open(filename + ".manifest"):
+        key, value = line.strip().split("=", 1)
+        manifest[key] = value if key == "sha256" else int(value)
+    return manifest
+
+
+def write_output(cmd, filename, compression_level=9):
+    '''Run osmconvert streaming its output to outputfile
+    Output is not published if osmconvert fails.
+    '''
+    res_file = outputfile(filename, compression_level)
+    proc = None
+    try:
+        proc = _subprocess().Popen(cmd, shell=False, bufsize=1 << 16,
+                                   stdout=_subprocess().PIPE)
+        res_file.writelines(iter(lambda: proc.stdout.read(1 << 16), ""))
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise AssertionError("Creating of output file failed: " +
+                                 " ".join(cmd))
+        res_file.close()
+    except:
+        #also missing osmconvert, full disk or interrupt
+        res_file.abort()
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+        raise
+
+
+def startup_report(elapsed, lazy_modules):
+    '''Print import time and check that 'lazy_modules' were not imported
+    return False if some of them were
+    '''
+    print("import time: %.3f s" % elapsed)
+    loaded = [name for name in lazy_modules if name in sys.modules]
+    if loaded:
+        print("imported too early: " + ", ".join(loaded))
+    return not loaded
+
+
+def out_format_arg(filename):
+    '''osmconvert argument selecting output format of data file'''
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    if filename.endswith(".pbf"):
+        return "--out-pbf"
+    elif filename.endswith(".o5m"):
+        return "--out-o5m"
+    elif filename.endswith(".osh"):
+        return "--out-osh"
+    else:
+        return "--out-osm"
+
+
+def shard_bboxes(count):
+    '''Split the planet into 'count' longitude stripes
+    return list of bounding boxes in osmconvert -b format
+    '''
+    width = 360.0 / count
+    return ["%.7f,-90,%.7f,90" % (-180 + i * width, -180 + (i + 1) * width)
+            for i in range(count)]
+
+
+def shard_name(filename, num, count):
+    '''Name of shard 'num' of 'count' of data file 'filename'
+    example: "planet.o5m" -> "planet.shard003of008.o5m"
+    Shards are never gzipped.
+    '''
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    base, ext = os.path.splitext(filename)
+    return "%s.shard%03iof%03i%s" % (base, num, count, ext)
+
+
+def find_shards(filename, count=None):
+    '''Complete set of shards of data file 'filename'
+    With 'count' only the layout of that many stripes is looked for,
+    otherwise any layout found on disk.
+    return list of shard filenames or [] if there is no complete set
+    '''
+    import glob
+    import re
+    if count:
+        counts = [count]
+    else:
+        pattern = shard_name(filename, 0, 0).replace("of000", "of*")
+        counts = []
+        for name in glob.glob(pattern):
+            found = re.search(r"\.shard000of(\d+)", name)
+            if found:
+                counts.append(int(found.group(1)))
+    for count in sorted(counts):
+        shards = [shard_name(filename, num, count) for num in range(count)]
+        if all(os.path.exists(name) for name in shards):
+            return shards
+    return []
+
+
+def shard_sources(filename, count, resplit=False):
+    '''Data files sharded update of 'filename' starts from
+    Shards of 'count' stripes if all exist and 'filename' is not newer,
+    otherwise 'filename' itself, otherwise shards of another stripe
+    count. Anything but shards of 'count' stripes is split again.
+    With 'resplit' only 'filename' itself is used.
+    return (list of files, their timestamp); ([], None) if no data
+    '''
+    exists = os.path.exists(filename)
+    if resplit:
+        if not exists:
+            return ([], None)
+        return ([filename], get_file_timestamp(filename))
+    shards = find_shards(filename, count)
+    if shards:
+        timestamp = shards_timestamp(shards)
+        if not exists:
+            return (shards, timestamp)
+        file_timestamp = get_file_timestamp(filename)
+        if file_timestamp and timestamp and file_timestamp > timestamp:
+            logging.info("%s is newer than its shards." % filename)
+            return ([filename], file_timestamp)
+        return (shards, timestamp)
+    if exists:
+        return ([filename], get_file_timestamp(filename))
+    shards = find_shards(filename)
+    if shards:
+        return (shards, shards_timestamp(shards))
+    return ([], None)
+
+
+def shards_timestamp(shards):
+    '''Timestamp of a set of shards, all of them must agree'''
+    timestamps = set(get_file_timestamp(name) for name in shards)
+    if len(timestamps) != 1:
+        raise AssertionError("Shards have different timestamps: %s" %
+                             ", ".join(shards))
+    return timestamps.pop()
+
+
+def _run_osmconvert(job):
+    '''Run osmconvert writing its output to file
+    job is (cmd, filename); used as worker of process pool
+    return osmconvert exit status
+    '''
+    cmd, filename = job
+    try:
+        write_output(cmd, filename)
+    except AssertionError:
+        return 1
+    return 0
+
+
+def _run_pool(jobs, processes=None):
+    '''Run osmconvert jobs in parallel, raise if any fails
+    Not more than 'processes' (default: number of CPUs) at once.
+    '''
+    import multiprocessing
+    processes = min(processes or multiprocessing.cpu_count(), len(jobs))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_run_osmconvert, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for (cmd, filename), result in zip(jobs, results):
+        if result != 0 or not os.path.exists(filename):
+            raise AssertionError("Processing of shard failed: " +
+                                 " ".join(cmd))
+
+
+def _shard_tempfiles(tempdir, num):
+    #osmconvert uses fixed tempfile names for --complete-ways
+    #and -b, parallel jobs must not share them
+    return "-t=" + os.path.join(tempdir, "shard%03i" % num)
+
+
+def split_shards(data_files, shard_file, count, tempdir, processes=None):
+    '''Split data files into 'count' longitude stripe shards
+    named after 'shard_file'. Ways crossing stripe border are kept
+    with all their nodes in each shard they touch, multipolygon
+    relations with all their members (--complex-ways).
+    return list of shard filenames
+    '''
+    logging.info("Splitting %s into %i shards." % (", ".join(data_files),
+                                                   count))
+    jobs = []
+    for num, bbox in enumerate(shard_bboxes(count)):
+        filename = shard_name(shard_file, num, count)
+        cmd = [osmconvert]
+        cmd.extend(data_files)
+        cmd.extend(["-b=" + bbox, "--complete-ways", "--complex-ways",
+                    _shard_tempfiles(tempdir, num),
+                    out_format_arg(filename)])
+        jobs.append((cmd, filename))
+    _run_pool(jobs, processes)
+    return [filename for cmd, filename in jobs]
+
+
+def apply_sharded(old_file, old_shards, changefile, new_file, count,
+                  tempdir, processes=None):
+    '''Apply changefile to sharded data in parallel
+    'old_shards' are data files from shard_sources(old_file); they are
+    split first unless they are shards of 'count' stripes already.
+    Each shard is updated from itself and both neighbour shards, so
+    ways which become crossing the stripe border get their unchanged
+    nodes from the neighbour. Nodes two or more stripes away and
+    members of relations outside the neighbours are not looked for,
+    such references stay dangling in the shards. Merging all shards
+    brings them back, so shards split again from merged data
+    (--concat-shards, then --resplit) are complete.
+    Changefile is clipped by the stripe in the same run.
+    return list of new shard filenames
+    '''
+    if old_shards != find_shards(old_file, count):
+        old_shards = split_shards(old_shards, old_file, count,
+                                  tempdir, processes)
+    logging.info("Updating %i shards." % count)
+    jobs = []
+    for num, bbox in enumerate(shard_bboxes(count)):
+        filename = shard_name(new_file, num, count)
+        cmd = [osmconvert]
+        if count > 1:
+            cmd.append(old_shards[num - 1])
+        cmd.append(old_shards[num])
+        if count > 2:
+            cmd.append(old_shards[(num + 1) % count])
+        cmd.extend([changefile, "-b=" + bbox,
+                    "--complete-ways", "--complex-ways",
+                    _shard_tempfiles(tempdir, num),
+                    out_format_arg(filename)])
+        jobs.append((cmd, filename))
+    _run_pool(jobs, processes)
+    return [filename for cmd, filename in jobs]
 
 
 if __name__ == "__main__":
+    if "--startup-benchmark" in sys.argv[1:]:
+        sys.exit(0 if startup_report(time.time() - _started,
+                                     ["argparse", "urllib", "subprocess",
+                                      "tempfile", "shutil", "hashlib",
+                                      "gzip", "multiprocessing"]) else 1)
+    import argparse
+    import shutil
     ap = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
     description="Osmupdate " + version + """
@@ -325,6 +752,12 @@ Please send any bug reports to scondo@mail.ru
     Instead of the second parameter, you alternatively may specify the
 name of a change file (.osc or .o5c). In this case, you also may
 replace the name of the old OSM data file by a timestamp.""")
+    ap.add_argument("--until",
+                    help="""Assemble changes only up to this timestamp
+instead of up to now, e.g.: 2011-07-20T00:00:00Z or NOW-86400. Only
+changefiles between the old file timestamp and this one are downloaded.
+Together with a timestamp as first parameter this extracts a changefile
+for a past time range.""")
     ap.add_argument("--maxdays", type=int, default=250, help="""
     Maximum time range for to assemble a cumulated changefile
     (default: %(default)s). Please ensure that there are daily change files
@@ -346,7 +779,8 @@ while being processed. For this reason, the number of parallely processable
 changefiles is limited. Use this commandline argument to determine the
 maximum number of parallely processed changefiles. (default: %(default)s)""")
     ap.add_argument("--tempfiles", "-t",
-                    default=os.path.join(tempfile.gettempdir(), "osmupdate"),
+                    default=os.path.join(_tempfile().gettempdir(),
+                                         "osmupdate"),
                     help="""On order to cache changefiles, osmupdate needs
 a separate directory. This parameter defines the name of this directory,
 including the prefix of the tempfiles' names. (default: "%(default)s")""")
@@ -371,6 +805,30 @@ the geographical region. The format of a border polygon file can be
 found in the OSM Wiki. You do not need to strictly follow the
 format description, you must ensure that every line of coordinates
 starts with blanks.""")
+    ap.add_argument("--shards", type=int,
+                    help="""Keep OSM data as a set of longitude stripe
+shards named like "old_file.shard000of008.o5m" and update them in
+parallel. Shards are created from old file if they do not exist yet or
+old file is newer than them, otherwise from shards with another stripe
+count. Timestamp is taken from the data actually updated. Ways crossing
+a stripe border keep all their nodes in every shard they touch. On
+update missing nodes are taken only from the neighbour shards: a way
+newly reaching nodes two or more stripes away, or a relation with
+members outside the neighbour shards, gets dangling references in the
+new shards. The file written by --concat-shards is complete; use it
+as old file with --resplit to start from complete shards again.
+Cannot be combined with -b or -B. (default: no sharding)""")
+    ap.add_argument("--shard-processes", type=int,
+                    help="""Number of shards processed in parallel.
+Every process needs memory for three shards and the changefile.
+(default: number of CPUs, not more than number of shards)""")
+    ap.add_argument('--concat-shards', action='store_true',
+                    help="""Also write new file as a single file
+concatenated from the updated shards.""")
+    ap.add_argument('--resplit', action='store_true',
+                    help="""Ignore existing shards of old file and split
+old file again. Together with --concat-shards in every run this keeps
+references between shards complete, at the cost of a split pass.""")
     ap.add_argument("--base-url", default=global_base_url,
                     help="""To accelerate downloads or to get regional
 file updates you may specify an alternative download location. Please
@@ -380,10 +838,22 @@ planet server. (default: "%(default)s")""")
                     help="""To use old planet URLs, you may need to add
 the suffix "-replicate" because it was custom to have this word in the
 URL, right after the period identifier "day" etc.(default: "%(default)s")""")
+    ap.add_argument('--startup-benchmark', action='store_true',
+                    help="""Only report time spent importing this program
+and fail if modules which should be imported on demand were imported
+eagerly. Other arguments are not needed then.""")
     ap.add_argument('--verbose', '-v', action='store_true',
                     help="""With activated "verbose" mode, some statistical
                      data and diagnosis data will be displayed.""")
     args = ap.parse_args()
+    if args.shards is not None and args.shards < 1:
+        ap.error("--shards must be at least 1")
+    if args.shard_processes is not None and args.shard_processes < 1:
+        ap.error("--shard-processes must be at least 1")
+    if not args.shards and (args.concat_shards or args.resplit or
+                            args.shard_processes):
+        ap.error("--concat-shards, --resplit and --shard-processes "
+                 "require --shards")
     if args.verbose:
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s %(levelname)s: %(message)s',
@@ -412,10 +882,22 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
     if not os.path.exists(args.tempfiles):
         os.makedirs(args.tempfiles, 0700)
 
-    if os.path.exists(args.old_file):
-        old_timestamp = get_file_timestamp(args.old_file)
-    else:
+    if args.shards:
         if new_file_is_changefile:
+            raise AssertionError("Sharding requires OSM data output file.")
+        if final_osmconvert_arguments:
+            raise AssertionError("Sharding cannot be combined with -b or -B.")
+
+    old_shards = []
+    if args.shards:
+        #updated data may come from the shards, not from old file
+        (old_shards, old_timestamp) = shard_sources(args.old_file,
+                                                    args.shards,
+                                                    args.resplit)
+    if not old_shards:
+        if os.path.exists(args.old_file):
+            old_timestamp = get_file_timestamp(args.old_file)
+        elif new_file_is_changefile:
             old_timestamp = strtodatetime(args.old_file)
         else:
             raise AssertionError("Old OSM file does not exist: %.80s" %
@@ -425,6 +907,14 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
                              "timestamp: %.80s" % args.old_file)
     if args.old_file == args.new_file:
         raise AssertionError("Input file and output file are identical.")
+    until_timestamp = None
+    if args.until:
+        until_timestamp = strtodatetime(args.until)
+        if not until_timestamp:
+            raise AssertionError("Wrong --until timestamp: %.80s" % args.until)
+        if until_timestamp <= old_timestamp:
+            raise AssertionError("--until timestamp is not newer than "
+                                 "old file timestamp.")
 
     # initialize files enumerators
     minutely_files = hourly_files = daily_files = sporadic_files = None
@@ -452,16 +942,20 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
         if not minutely_files.lasttime():
             raise AssertionError("Could not get the newest minutely timestamp"
                                  " from the Internet.")
+        if until_timestamp:
+            minutely_files.seek(until_timestamp)
     if args.hour:
         hourly_files = changefiles("hourly")
         if not hourly_files.lasttime():
             raise AssertionError("Could not get the newest hourly timestamp"
                                  " from the Internet.")
         else:
+            if until_timestamp:
+                hourly_files.seek(until_timestamp)
             #Do not use hourly files
             #if OSM old file's timestamp > latest hourly timestamp - 30 minutes
             if minutely_files is not None and \
-            (hourly_files.lasttime() - old_timestamp).total_seconds() < 1800:
+            (hourly_files.nowtime - old_timestamp).total_seconds() < 1800:
                 hourly_files = None
 
     if args.day:
@@ -470,10 +964,12 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
             raise AssertionError("Could not get the newest daily timestamp"
                                  " from the Internet.")
         else:
+            if until_timestamp:
+                daily_files.seek(until_timestamp)
             #Do not use daily files
             #if OSM old file's timestamp > latest daily timestamp - 16 hours
             if hourly_files is not None or minutely_files is not None and \
-            (daily_files.lasttime() - old_timestamp).total_seconds() < 57600:
+            (daily_files.nowtime - old_timestamp).total_seconds() < 57600:
                 daily_files = None
 
     if args.sporadic and not sporadic_files:
@@ -481,29 +977,31 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
         if not sporadic_files.lasttime():
             raise AssertionError("Could not get the newest sporadic timestamp"
                                  " from the Internet.")
+    if sporadic_files is not None and until_timestamp:
+        sporadic_files.seek(until_timestamp)
 
     #Check maximum update range
     if daily_files is not None:
-        days_range = (daily_files.lasttime() - old_timestamp).days()
+        days_range = (daily_files.nowtime - old_timestamp).days
     elif hourly_files is not None:
-        days_range = (hourly_files.lasttime() - old_timestamp).days()
+        days_range = (hourly_files.nowtime - old_timestamp).days
     elif minutely_files is not None:
-        days_range = (minutely_files.lasttime() - old_timestamp).days()
+        days_range = (minutely_files.nowtime - old_timestamp).days
     elif sporadic_files is not None:
-        days_range = (sporadic_files.lasttime() - old_timestamp).days()
+        days_range = (sporadic_files.nowtime - old_timestamp).days
 
     if days_range > args.maxdays:
         #Update range too large
         raise AssertionError("Update range too large: %i days. \n To allow"
-                             " such a wide range, add: --max-days=%i" % \
-                             days_range)
+                             " such a wide range, add: --maxdays=%i" % \
+                             (days_range, days_range))
     fcache = filecache(args.tempfiles)
 
     #Get and process minutely diff files from last minutely timestamp backward;
     #stop just before latest hourly timestamp
     #or OSM file timestamp has been reached;
     if minutely_files is not None:
-        hour_to = hourly_files.lasttime() if hourly_files \
+        hour_to = hourly_files.nowtime if hourly_files \
                     else datetime(1900, 1, 1)
         while minutely_files.nowtime > hour_to \
             and minutely_files.nowtime > old_timestamp:
@@ -514,7 +1012,7 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
     #backward; stop just before last daily timestamp or
     #OSM file timestamp has been reached;
     if not (hourly_files is None):
-        day_to = daily_files.lasttime() if daily_files \
+        day_to = daily_files.nowtime if daily_files \
                     else datetime(1900, 1, 1)
         while hourly_files.nowtime > day_to \
             and hourly_files.nowtime > old_timestamp:
@@ -534,7 +1032,13 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
                                         sporadic_files.nowtime)
             sporadic_files.nownum -= 1
     #Merging all files in cache and getting result file
-    master_cachefile_name = fcache.resultfile(args.maxmerge)
+    if new_file_is_changefile and new_file_is_o5:
+        #last merge writes o5c result itself, no extra copy
+        master_cachefile_name = fcache.resultfile(args.maxmerge,
+                                                  args.new_file,
+                                                  args.compression_level)
+    else:
+        master_cachefile_name = fcache.resultfile(args.maxmerge)
     logging.info("Creating output file.")
     if not os.path.exists(master_cachefile_name):
         if os.path.exists(args.old_file):
@@ -543,45 +1047,38 @@ args.new_file.endswith(".osc.gz") or args.new_file.endswith(".o5c.gz")
         else:
             raise AssertionError("Your OSM file is already up-to-date.")
     else:
-        if args.new_file.endswith(".gz"):
-            import gzip
-            res_file = gzip.open(args.new_file, 'wb', args.compression_level)
+        if args.shards:
+            new_shards = apply_sharded(args.old_file, old_shards,
+                                       master_cachefile_name,
+                                       args.new_file, args.shards,
+                                       args.tempfiles, args.shard_processes)
+            if args.concat_shards:
+                logging.info("Concatenating shards.")
+                cmd = [osmconvert]
+                cmd.extend(new_shards)
+                cmd.append(out_format_arg(args.new_file))
+                write_output(cmd, args.new_file, args.compression_level)
         else:
-            if not (new_file_is_changefile and new_file_is_o5):
-                res_file = open(args.new_file, 'wb')
-        cmd = [osmconvert]
-        if new_file_is_changefile:
-            if new_file_is_o5:
-                if args.new_file.endswith(".gz"):
-                    f_in = open(master_cachefile_name, 'rb')
-                    res_file.writelines(f_in)
-                    f_in.close()
-                else:
-                    os.rename(master_cachefile_name, args.new_file)
+            cmd = [osmconvert]
+            if new_file_is_changefile:
+                #o5c result is already written by resultfile
+                if not new_file_is_o5:
+                    cmd.append(master_cachefile_name)
+                    cmd.append("--out-osc")
+                    write_output(cmd, args.new_file, args.compression_level)
             else:
+                cmd.extend(final_osmconvert_arguments)
+                cmd.append(args.old_file)
                 cmd.append(master_cachefile_name)
-                cmd.append("--out-osc")
-                res = subprocess.Popen(cmd, shell=False, bufsize=1024,
-                                       stdout=subprocess.PIPE).stdout
-                res_file.writelines(res)
-                res.close()
-        else:
-            cmd.extend(final_osmconvert_arguments)
-            cmd.append(args.old_file)
-            cmd.append(master_cachefile_name)
-            if new_file_is_pbf:
-                cmd.append("--out-pbf")
-            elif new_file_is_o5:
-                cmd.append("--out-o5m")
-            else:
-                cmd.append("--out-osm")
-            res = subprocess.Popen(cmd, shell=False, bufsize=1024,
-                                   stdout=subprocess.PIPE).stdout
-            res_file.writelines(res)
-            res.close()
-        if not (new_file_is_changefile and new_file_is_o5):
-            res_file.close()
-        remove(master_cachefile_name)
+                if new_file_is_pbf:
+                    cmd.append("--out-pbf")
+                elif new_file_is_o5:
+                    cmd.append("--out-o5m")
+                else:
+                    cmd.append("--out-osm")
+                write_output(cmd, args.new_file, args.compression_level)
+        if master_cachefile_name != args.new_file:
+            remove(master_cachefile_name)
         if args.keep_tempfiles:
             logging.info("Keeping temporary files.")
         else: